@@ -1,30 +1,67 @@
-import logging
-from typing import Dict
+import asyncio
+from copy import deepcopy
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
 # from json import JSONDecodeError
 
-from operator import itemgetter
-from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
-from langchain_core.exceptions import OutputParserException
 from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough
+from langchain_core.runnables import (
+    Runnable,
+    RunnableBranch,
+    RunnableLambda,
+    RunnableParallel,
+    RunnablePassthrough,
+)
 from langchain_openai import ChatOpenAI
 from langchain.chains.base import Chain
+from langchain_core.globals import get_llm_cache, set_llm_cache
+from langchain_community.cache import InMemoryCache, RedisCache
+from openai import APIConnectionError, InternalServerError, RateLimitError
 
 from .prompts import (
     HATESPEECH_DETECTOR_PROMPT,
     HATESPEECH_VALIDATOR_PROMPT,
     HATESPEECH_CLASSIFICATION_PROMPT,
     RIGHT_WING_RATING_PROMPT,
+    HATESPEECH_DETECT_AND_VALIDATE_PROMPT,
 )
 from .prompts import (
     HatespeechDetectionFormat,
     HatespeechValidatorFormat,
     HatespeechClassifierFormat,
     RightWingRatingFormat,
+    DetectValidateFormat,
 )
-from .llm_chains import get_openai_moderator_results
+from .prompts import get_json_parser
+from .llm_chains import aget_openai_moderator_results
 from .llm_chains import OpenAIModerationChain
+from .llm_chains import bind_json_mode
+
+
+# Identical messages are answered from the cache instead of calling the API
+# again. The prompts are static, so only the message changes the cache key.
+# A cache which was set before the import is kept. The InMemoryCache is not
+# limited and grows with every new message - use set_redis_llm_cache (with a
+# ttl) for long running processes.
+if get_llm_cache() is None:
+    set_llm_cache(InMemoryCache())
+
+
+def set_redis_llm_cache(
+    redis_url: str = "redis://localhost:6379", ttl: Optional[int] = None
+) -> None:
+    """Replaces the default InMemoryCache with a RedisCache, so multiple
+    workers can share the cached LLM results. Needs the ``redis`` package.
+
+    Args:
+        redis_url (str, optional):
+            URL of the redis server. Defaults to "redis://localhost:6379".
+        ttl (Optional[int], optional):
+            Time to live of the cached results in seconds. Defaults to None.
+    """
+    from redis import Redis
+
+    set_llm_cache(RedisCache(redis_=Redis.from_url(redis_url), ttl=ttl))
 
 
 _text_analyser_prompts = [
@@ -34,29 +71,119 @@ _text_analyser_prompts = [
     (RIGHT_WING_RATING_PROMPT, RightWingRatingFormat),
 ]
 
+# Detector and validator are merged into one prompt, so every branch of the
+# parallel chain needs only one request
+_parallel_analyser_prompts = [
+    (HATESPEECH_DETECT_AND_VALIDATE_PROMPT, DetectValidateFormat),
+    (HATESPEECH_CLASSIFICATION_PROMPT, HatespeechClassifierFormat),
+    (RIGHT_WING_RATING_PROMPT, RightWingRatingFormat),
+]
+
+# Parsers are built once, the pydantic schema doesn't change between calls
+_PARSERS = {
+    prompt.name: get_json_parser(parser_object)
+    for prompt, parser_object in _text_analyser_prompts + _parallel_analyser_prompts
+}
+
+
+_REQUEST_TIMEOUT = 8.0
+_MAX_RETRIES = 1
+# APIConnectionError includes the APITimeoutError
+_RETRY_EXCEPTIONS = (APIConnectionError, RateLimitError, InternalServerError)
+
+
+def _build_llm_chains(
+    llm: BaseChatModel, max_retries: int, json_mode: bool
+) -> Dict[str, Runnable]:
+    if json_mode:
+        llm = bind_json_mode(llm)
+    chains = {}
+    for prompt, _ in _parallel_analyser_prompts:
+        chains[prompt.name] = (prompt | llm | _PARSERS[prompt.name]).with_retry(
+            retry_if_exception_type=_RETRY_EXCEPTIONS,
+            stop_after_attempt=max_retries + 1,
+        )
+
+    return chains
+
+
+def _build_chain(
+    llm: BaseChatModel, moderator: Chain, max_retries: int, json_mode: bool
+) -> RunnableParallel:
+    chains = _build_llm_chains(llm, max_retries, json_mode)
+
+    map_chain = RunnableParallel(
+        detection=chains["detection"],
+        classifier=chains["classifier"],
+        right_wing_rater=chains["right-wing-rater"],
+        moderator=moderator,
+    )
+
+    return map_chain
+
+
+# The clients don't retry by themselves, a timed out, rate limited or failed
+# request is retried by the chain instead of waiting for the slow tail of the api
+_DEFAULT_LLM = ChatOpenAI(timeout=_REQUEST_TIMEOUT, max_retries=0)
+_DEFAULT_MODERATOR = OpenAIModerationChain(
+    timeout=_REQUEST_TIMEOUT, max_retries=_MAX_RETRIES
+)
+_DEFAULT_CHAIN = _build_chain(_DEFAULT_LLM, _DEFAULT_MODERATOR, _MAX_RETRIES, True)
+
+
+def _uses_defaults(
+    llm: Optional[BaseChatModel],
+    moderator: Optional[Chain],
+    request_timeout: float,
+    max_retries: int,
+    json_mode: bool,
+) -> bool:
+    return (
+        llm is None
+        and moderator is None
+        and request_timeout == _REQUEST_TIMEOUT
+        and max_retries == _MAX_RETRIES
+        and json_mode
+    )
+
 
-# TODO: add retry or output-fixing parser
 def parallel_text_analyser_chains(
-    llm: BaseChatModel = ChatOpenAI(),
-    moderator: Chain = OpenAIModerationChain()
+    llm: Optional[BaseChatModel] = None,
+    moderator: Optional[Chain] = None,
+    request_timeout: float = _REQUEST_TIMEOUT,
+    max_retries: int = _MAX_RETRIES,
+    json_mode: bool = True,
 ) -> RunnableParallel:
     """Parallel running chain, all sharing the same LLM. This chain is
-    restricted to the prompts listed in _text_analyser_prompts. The parallel
-    chain invokes 4 times the llm with 4 different prompts. Additionaly it
+    restricted to the prompts listed in _parallel_analyser_prompts. The
+    parallel chain invokes 3 times the llm with 3 different prompts (detector
+    and validator are combined in one prompt). Additionaly it
     passes the input message to a moderation chain. To invoke the you need to
     pass a dictionary with "message" as a key.
 
     Args:
         llm (BaseChatModel, optional):
             Pass a llm instance which works with langchain's PromptTemplate
-            and JSON Parser. Defaults to ChatOpenAI().
+            and JSON Parser. Defaults to None -> ChatOpenAI().
         moderator (Chain, optional):
             Pass an additional chain to get the result of the moderator.
-            Defaults to OpenAIModerationChain(). (from llm_chains)
+            Defaults to None -> OpenAIModerationChain(). (from llm_chains)
+        request_timeout (float, optional):
+            Timeout in seconds of a single request of the default llm and
+            moderator. Defaults to 8.0.
+        max_retries (int, optional):
+            How often a timed out, rate limited or failed (connection or
+            server error) llm request is retried. Defaults to 1.
+        json_mode (bool, optional):
+            Runs ChatOpenAI llms in OpenAI's JSON mode. Only models with
+            JSON mode support it (e.g. gpt-3.5-turbo-1106 or gpt-4-turbo, not
+            gpt-4-0613 or Azure deployments with older api versions), for
+            other models set it to False. Defaults to True.
 
     Returns:
         RunnableParallel: Runnable chain which you can invoke (and other
-        methods)
+        methods). With the default arguments the chain built at import is
+        returned.
 
     Example:
         from ki_gegen_rechts.analyser import parallel_text_analyser_chains
@@ -64,59 +191,323 @@ def parallel_text_analyser_chains(
         analyser_full_chain = parallel_text_analyser_chains(llm)
         result = analyser_full_chain.invoke({"message": "You suck!"})
     """
-    chains = {}
-    for prompt, parser_object in _text_analyser_prompts:
-        parser = JsonOutputParser(pydantic_object=parser_object)
-        chains[prompt.name] = prompt | llm | parser
-
-    # Setting up detector with validator chain
-    detector_chain = chains["detector"] | {
-        "message": RunnablePassthrough(),
-        "classification": itemgetter("classification"),
-        "explanation": itemgetter("explanation"),
-    }
-    # TODO: How can I concat both chains but getting the results of both chains
-    # at the end? The 2nd chain needs the input of the first chain. hacky workaround atm
-    validator_chain = {
-        "detector": {
-            "classification": itemgetter("classification"),
-            "explanation": itemgetter("explanation"),
-        },
-        "validator": chains["validator"],
+    if _uses_defaults(llm, moderator, request_timeout, max_retries, json_mode):
+        return _DEFAULT_CHAIN
+
+    llm = llm or ChatOpenAI(timeout=request_timeout, max_retries=0)
+    moderator = moderator or OpenAIModerationChain(
+        timeout=request_timeout, max_retries=max_retries
+    )
+
+    return _build_chain(llm, moderator, max_retries, json_mode)
+
+
+_NO_HATE_SPEECH = "no hate speech"
+_SKIPPED = "Skipped"
+_SKIPPED_EXPLANATION = "Skipped - no hate speech was detected."
+
+# Results for the skipped chains of routed_text_analyser_chains. The
+# classification and rating are "Skipped", a value the llm never returns, so
+# the stubs can't be mistaken for real results.
+_BENIGN_CLASSIFIER = {
+    "classification": _SKIPPED,
+    "racism": False,
+    "antisemitism": False,
+    "homophobia": False,
+    "ableism": False,
+    "violence": False,
+    "sexism": False,
+    "other_hate_speech": False,
+    "explanation": _SKIPPED_EXPLANATION,
+}
+_BENIGN_RIGHT_WING_RATER = {
+    "right_wing_indicator": False,
+    "rating": _SKIPPED,
+    "explanation": _SKIPPED_EXPLANATION,
+}
+
+
+def _is_no_hate_speech(classification: str) -> bool:
+    return str(classification).strip().rstrip(".").lower() == _NO_HATE_SPEECH
+
+
+def _is_benign(result: Dict) -> bool:
+    """Detector, validator and moderator agree that there is no hate speech"""
+    detection = result["detection"]
+    return (
+        not result["moderator"]["mod_results"]["flagged"]
+        and _is_no_hate_speech(detection["detector"]["classification"])
+        and _is_no_hate_speech(detection["validator"]["classification"])
+    )
+
+
+def _skip_classification(result: Dict) -> Dict:
+    return {
+        **result,
+        "classifier": dict(_BENIGN_CLASSIFIER),
+        "right_wing_rater": dict(_BENIGN_RIGHT_WING_RATER),
     }
 
-    map_chain = RunnableParallel(
-        detection=(detector_chain | validator_chain),
+
+def _drop_message(result: Dict) -> Dict:
+    return {k: v for k, v in result.items() if k != "message"}
+
+
+def _build_routed_chain(
+    llm: BaseChatModel, moderator: Chain, max_retries: int, json_mode: bool
+) -> Runnable:
+    chains = _build_llm_chains(llm, max_retries, json_mode)
+
+    detection_chain = RunnablePassthrough.assign(
+        detection=chains["detection"], moderator=moderator
+    )
+    classification_chain = RunnablePassthrough.assign(
         classifier=chains["classifier"],
         right_wing_rater=chains["right-wing-rater"],
-        moderator=moderator,
+    )
+    route = RunnableBranch(
+        (_is_benign, RunnableLambda(_skip_classification)), classification_chain
     )
 
-    return map_chain
+    return detection_chain | route | RunnableLambda(_drop_message)
+
+
+_DEFAULT_ROUTED_CHAIN = _build_routed_chain(
+    _DEFAULT_LLM, _DEFAULT_MODERATOR, _MAX_RETRIES, True
+)
 
 
-# This function takes 10-20 seconds per message, because it invokes the
-# chains in a loop. First attempt -> probably can be deleted
-def analyse_text_message_with_llm(
-    message: str, llm: BaseChatModel = ChatOpenAI()
+def routed_text_analyser_chains(
+    llm: Optional[BaseChatModel] = None,
+    moderator: Optional[Chain] = None,
+    request_timeout: float = _REQUEST_TIMEOUT,
+    max_retries: int = _MAX_RETRIES,
+    json_mode: bool = True,
+) -> Runnable:
+    """Same results as parallel_text_analyser_chains, but the classifier and
+    the right wing rater only run if the message could contain hate speech.
+    First the detection prompt and the moderator run in parallel. If both
+    classifications are "No hate speech" and the moderator didn't flag the
+    message, the other chains are skipped and filled with default results:
+    all booleans are False and the classification of the classifier and the
+    rating of the right wing rater are "Skipped". Benign messages need 1
+    instead of 3 llm requests, all others take one request longer.
+
+    Args:
+        llm (BaseChatModel, optional):
+            See parallel_text_analyser_chains. Defaults to None.
+        moderator (Chain, optional):
+            See parallel_text_analyser_chains. Defaults to None.
+        request_timeout (float, optional):
+            See parallel_text_analyser_chains. Defaults to 8.0.
+        max_retries (int, optional):
+            See parallel_text_analyser_chains. Defaults to 1.
+        json_mode (bool, optional):
+            See parallel_text_analyser_chains. Defaults to True.
+
+    Returns:
+        Runnable: Runnable chain which you can invoke (and other methods).
+        With the default arguments the chain built at import is returned.
+
+    Example:
+        from ki_gegen_rechts.analyser import routed_text_analyser_chains
+        analyser_routed_chain = routed_text_analyser_chains()
+        result = analyser_routed_chain.invoke({"message": "Nice day!"})
+    """
+    if _uses_defaults(llm, moderator, request_timeout, max_retries, json_mode):
+        return _DEFAULT_ROUTED_CHAIN
+
+    llm = llm or ChatOpenAI(timeout=request_timeout, max_retries=0)
+    moderator = moderator or OpenAIModerationChain(
+        timeout=request_timeout, max_retries=max_retries
+    )
+
+    return _build_routed_chain(llm, moderator, max_retries, json_mode)
+
+
+async def analyse_many(
+    messages: List[str],
+    concurrency: int = 10,
+    llm: Optional[BaseChatModel] = None,
+    moderator: Optional[Chain] = None,
+    json_mode: bool = True,
+) -> List[Dict]:
+    """Analyses a list of messages with parallel_text_analyser_chains. The
+    chain is built once and the messages are sent with abatch, so at most
+    `concurrency` messages are processed at the same time.
+
+    Args:
+        messages (List[str]):
+            Messages you want to analyse.
+        concurrency (int, optional):
+            Max. number of messages processed at the same time. Keep it low
+            enough to respect the rate limits of your OpenAI account.
+            Defaults to 10.
+        llm (BaseChatModel, optional):
+            See parallel_text_analyser_chains. Defaults to None.
+        moderator (Chain, optional):
+            See parallel_text_analyser_chains. Defaults to None.
+        json_mode (bool, optional):
+            See parallel_text_analyser_chains. Defaults to True.
+
+    Returns:
+        List[Dict]: Results in the same order as the messages
+
+    Example:
+        import asyncio
+        from ki_gegen_rechts.analyser import analyse_many
+        results = asyncio.run(analyse_many(["You suck!", "Nice day!"]))
+    """
+    chain = parallel_text_analyser_chains(llm, moderator, json_mode=json_mode)
+    return await chain.abatch(
+        [{"message": message} for message in messages],
+        config={"max_concurrency": concurrency},
+    )
+
+
+async def analyse_many_dedup(
+    messages: List[str],
+    concurrency: int = 10,
+    llm: Optional[BaseChatModel] = None,
+    moderator: Optional[Chain] = None,
+    json_mode: bool = True,
+) -> List[Dict]:
+    """Same as analyse_many, but duplicated messages (ignoring case and
+    leading/trailing whitespace) are only sent once. The results are copied
+    back to every position of the duplicates.
+
+    Args:
+        messages (List[str]):
+            Messages you want to analyse.
+        concurrency (int, optional):
+            See analyse_many. Defaults to 10.
+        llm (BaseChatModel, optional):
+            See parallel_text_analyser_chains. Defaults to None.
+        moderator (Chain, optional):
+            See parallel_text_analyser_chains. Defaults to None.
+        json_mode (bool, optional):
+            See parallel_text_analyser_chains. Defaults to True.
+
+    Returns:
+        List[Dict]: Results in the same order as the messages
+    """
+    keys = [message.strip().lower() for message in messages]
+    unique_messages = {}
+    for key, message in zip(keys, messages):
+        unique_messages.setdefault(key, message)
+
+    results = await analyse_many(
+        list(unique_messages.values()), concurrency, llm, moderator, json_mode
+    )
+    lookup = dict(zip(unique_messages, results))
+    seen = set()
+    dedup_results = []
+    for key in keys:
+        # Duplicates get their own copy, so changing one result doesn't
+        # change the others
+        dedup_results.append(deepcopy(lookup[key]) if key in seen else lookup[key])
+        seen.add(key)
+
+    return dedup_results
+
+
+async def astream_analysis(
+    message: str,
+    llm: Optional[BaseChatModel] = None,
+    moderator: Optional[Chain] = None,
+    json_mode: bool = True,
+) -> AsyncIterator[Dict]:
+    """Streams the results of parallel_text_analyser_chains. The JSON parsers
+    return the partially parsed outputs while the tokens arrive, so you can
+    start rendering before the (long) explanations are finished. Every
+    yielded dictionary contains the latest state of all branches which
+    already started to answer.
+
+    Args:
+        message (str):
+            Message you want to analyse.
+        llm (BaseChatModel, optional):
+            See parallel_text_analyser_chains. Defaults to None.
+        moderator (Chain, optional):
+            See parallel_text_analyser_chains. Defaults to None.
+        json_mode (bool, optional):
+            See parallel_text_analyser_chains. Defaults to True.
+
+    Yields:
+        Dict: Partial results with the same keys as
+        parallel_text_analyser_chains
+
+    Example:
+        from ki_gegen_rechts.analyser import astream_analysis
+        async for partial_result in astream_analysis("You suck!"):
+            print(partial_result)
+    """
+    chain = parallel_text_analyser_chains(llm, moderator, json_mode=json_mode)
+    result = {}
+    async for chunk in chain.astream({"message": message}):
+        # Parsers yield the whole parsed output so far, not the difference
+        result.update(chunk)
+        yield dict(result)
+
+
+# First attempt -> probably can be deleted. The chains were invoked in a loop
+# (10-20 seconds per message), now they run concurrently. Only the validator
+# has to wait for the detector.
+async def analyse_text_message_with_llm(
+    message: str, llm: BaseChatModel = ChatOpenAI(), json_mode: bool = True
 ) -> Dict[str, str]:
-    input, results = {"message": message}, {}
-    results["moderator"] = get_openai_moderator_results(message)
-
-    # Initialize LLM chains
-    for prompt, parser_object in _text_analyser_prompts:
-        parser = JsonOutputParser(pydantic_object=parser_object)
-        chain = prompt | llm | parser
-        try:
-            chain_output: dict = chain.invoke(input)
-        except OutputParserException:
-            logging.warning("Parsing failed - Switching parser to StrOutputParser")
-            chain = prompt | llm | StrOutputParser()
-            chain_output: str = chain.invoke(input)
-
-        if prompt.name == "detector":
-            input.update(chain_output)
-
-        results[prompt.name] = chain_output
-
-    return results
+    """Analyses a message with all prompts of _text_analyser_prompts and the
+    moderation model. All requests are sent concurrently, so the runtime is
+    roughly the one of the slowest request (detector + validator).
+
+    Args:
+        message (str):
+            Message you want to analyse.
+        llm (BaseChatModel, optional):
+            Pass a llm instance which works with langchain's PromptTemplate
+            and JSON Parser. Defaults to ChatOpenAI().
+        json_mode (bool, optional):
+            See parallel_text_analyser_chains. Defaults to True.
+
+    Returns:
+        Dict[str, str]: Results with the prompt names and "moderator" as keys
+
+    Example:
+        import asyncio
+        from ki_gegen_rechts.analyser import analyse_text_message_with_llm
+        result = asyncio.run(analyse_text_message_with_llm("You suck!"))
+    """
+    input = {"message": message}
+    if json_mode:
+        llm = bind_json_mode(llm)
+    chains = {
+        prompt.name: prompt | llm | _PARSERS[prompt.name]
+        for prompt, _ in _text_analyser_prompts
+    }
+
+    async def detect_then_validate() -> Tuple[Dict, Dict]:
+        detector_output = await chains["detector"].ainvoke(input)
+        validator_output = await chains["validator"].ainvoke(
+            {**input, **detector_output}
+        )
+        return detector_output, validator_output
+
+    (
+        (detector, validator),
+        classifier,
+        right_wing_rater,
+        moderator,
+    ) = await asyncio.gather(
+        detect_then_validate(),
+        chains["classifier"].ainvoke(input),
+        chains["right-wing-rater"].ainvoke(input),
+        aget_openai_moderator_results(message),
+    )
+
+    return {
+        "moderator": moderator,
+        "detector": detector,
+        "validator": validator,
+        "classifier": classifier,
+        "right-wing-rater": right_wing_rater,
+    }
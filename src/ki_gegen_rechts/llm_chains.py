@@ -1,17 +1,90 @@
-from typing import Any, Dict, List, Mapping, Optional, Union, Tuple
-
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Union,
+    Tuple,
+)
+
+import asyncio
 import os
+from functools import lru_cache
 
+import httpx
+import jsonpatch
 from langchain.chains.base import Chain
 from langchain_openai import ChatOpenAI
 from langchain.prompts import Prompt
-from langchain_core.output_parsers import BaseOutputParser
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.output_parsers import BaseOutputParser, JsonOutputParser
+from langchain_core.runnables import Runnable
 from openai import OpenAI, AsyncOpenAI
-from langchain_core.callbacks import CallbackManagerForChainRun
+from openai.types import Moderation
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForChainRun,
+    CallbackManagerForChainRun,
+)
 from langchain_core.pydantic_v1 import Field, root_validator
 from langchain_core.utils import get_from_dict_or_env
 from langchain_core.runnables.base import RunnableSequence
-from langchain_core.output_parsers.transform import BaseCumulativeTransformOutputParser
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import Generation
+
+# Shared connection pools, so the TLS connections are reused between requests
+# instead of being created for every moderation call
+_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=100)
+_HTTP_TIMEOUT = httpx.Timeout(30.0, connect=3.0)
+_HTTP_CLIENT = httpx.Client(limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT)
+# Async connections belong to the event loop which opened them, so every
+# running loop gets its own pool and AsyncOpenAI client (e.g. each asyncio.run
+# creates a new loop). Clients of closed loops are only dropped, not closed
+# with aclose() (that would need the closed loop), their sockets are released
+# when the clients are garbage collected.
+_ASYNC_HTTP_CLIENTS: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+_ASYNC_CLIENTS: Dict[asyncio.AbstractEventLoop, AsyncOpenAI] = {}
+
+
+@lru_cache(maxsize=None)
+def _get_client() -> OpenAI:
+    return OpenAI(http_client=_HTTP_CLIENT)
+
+
+def _drop_closed_loops(clients: Dict[asyncio.AbstractEventLoop, Any]) -> None:
+    for closed_loop in [lp for lp in clients if lp.is_closed()]:
+        del clients[closed_loop]
+
+
+def _get_async_http_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    _drop_closed_loops(_ASYNC_HTTP_CLIENTS)
+    if loop not in _ASYNC_HTTP_CLIENTS:
+        _ASYNC_HTTP_CLIENTS[loop] = httpx.AsyncClient(
+            limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT
+        )
+
+    return _ASYNC_HTTP_CLIENTS[loop]
+
+
+def _get_async_client() -> AsyncOpenAI:
+    loop = asyncio.get_running_loop()
+    _drop_closed_loops(_ASYNC_CLIENTS)
+    if loop not in _ASYNC_CLIENTS:
+        _ASYNC_CLIENTS[loop] = AsyncOpenAI(http_client=_get_async_http_client())
+
+    return _ASYNC_CLIENTS[loop]
+
+
+def _moderation_to_dict(result: Moderation) -> Dict:
+    """Only dumps the fields which are used instead of the whole model"""
+    return {
+        "categories": result.categories.model_dump(),
+        "category_scores": result.category_scores.model_dump(),
+        "flagged": result.flagged,
+    }
 
 
 # TODO: Check if a inheritance from BaseOpenAI is "better"
@@ -36,6 +109,9 @@ class OpenAIModerationChain(Chain):
     """
 
     client: Any  #: :meta private:
+    async_client: Any  #: :meta private:
+    client_params: Dict = Field(default_factory=dict)  #: :meta private:
+    async_clients: Dict = Field(default_factory=dict)  #: :meta private:
     model_name: Optional[str] = "text-moderation-latest"
     """Moderation model name to use."""
     error: bool = False
@@ -60,7 +136,10 @@ class OpenAIModerationChain(Chain):
     # Configure a custom httpx client. See the
     # [httpx documentation](https://www.python-httpx.org/api/#client) for more details.
     http_client: Union[Any, None] = None
-    """Optional httpx.Client."""
+    """Optional httpx.Client. Defaults to the shared module connection pool."""
+    http_async_client: Union[Any, None] = None
+    """Optional httpx.AsyncClient. Defaults to the module connection pool of
+        the running event loop."""
 
     @root_validator()
     def validate_environment(cls, values: Dict) -> Dict:
@@ -92,12 +171,13 @@ class OpenAIModerationChain(Chain):
             "max_retries": values["max_retries"],
             "default_headers": values["default_headers"],
             "default_query": values["default_query"],
-            "http_client": values["http_client"],
         }
         if not values.get("client"):
-            values["client"] = OpenAI(**client_params).moderations
-        if not values.get("async_client"):
-            values["async_client"] = AsyncOpenAI(**client_params).moderations
+            values["client"] = OpenAI(
+                **client_params, http_client=values["http_client"] or _HTTP_CLIENT
+            ).moderations
+        # The async clients are created in _acall, once per running event loop
+        values["client_params"] = client_params
 
         return values
 
@@ -124,7 +204,47 @@ class OpenAIModerationChain(Chain):
     ) -> Dict[str, str]:
         text = inputs[self.input_key]
         outputs = self.client.create(input=text, model=self.model_name)
-        return {self.output_key: outputs.results[0].model_dump()}
+        return {self.output_key: _moderation_to_dict(outputs.results[0])}
+
+    async def _acall(
+        self,
+        inputs: Dict[str, str],
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> Dict[str, str]:
+        text = inputs[self.input_key]
+        async_client = self.async_client or self._get_loop_async_client()
+        outputs = await async_client.create(input=text, model=self.model_name)
+        return {self.output_key: _moderation_to_dict(outputs.results[0])}
+
+    def _get_loop_async_client(self) -> Any:
+        loop = asyncio.get_running_loop()
+        _drop_closed_loops(self.async_clients)
+        if loop not in self.async_clients:
+            self.async_clients[loop] = AsyncOpenAI(
+                **self.client_params,
+                http_client=self.http_async_client or _get_async_http_client(),
+            ).moderations
+
+        return self.async_clients[loop]
+
+
+def bind_json_mode(llm: BaseChatModel) -> Runnable:
+    """Turns on OpenAI's JSON mode, so the model always answers with valid
+    JSON (no markdown fences or prose around it). Other llms are returned
+    unchanged. The model has to support JSON mode (e.g. gpt-3.5-turbo-1106 or
+    gpt-4-turbo), others like gpt-4-0613 fail with a 400 error.
+
+    Args:
+        llm (BaseChatModel):
+            The llm which should answer in JSON.
+
+    Returns:
+        Runnable: llm bound to response_format json_object
+    """
+    if isinstance(llm, ChatOpenAI):
+        return llm.bind(response_format={"type": "json_object"})
+
+    return llm
 
 
 def create_public_chat_gpt_chain(
@@ -134,7 +254,8 @@ def create_public_chat_gpt_chain(
     model_kwargs: Dict = {},
 ) -> RunnableSequence:
     """Simple LCEL chain for OpenAI which is build with a prompt, a llm and
-    a parser. The function returns a langchain chain.
+    a parser. The function returns a langchain chain. If the parser is a
+    JsonOutputParser, the llm runs in OpenAI's JSON mode.
 
     Args:
         prompt (Prompt):
@@ -152,6 +273,8 @@ def create_public_chat_gpt_chain(
         RunnableSequence: LCEL Chain
     """
     openai_llm = ChatOpenAI(model=model, temperature=0.0, **model_kwargs)
+    if isinstance(parser, JsonOutputParser):
+        openai_llm = bind_json_mode(openai_llm)
     chain = prompt | openai_llm | parser
 
     return chain
@@ -170,35 +293,96 @@ def get_openai_moderator_results(
             Defaults to "text-moderation-latest".
 
     Returns:
-        Dict: _description_
+        Dict: Results of the moderation model
     """
-    client = OpenAI()
+    client = _get_client()
     output = client.moderations.create(input=input_message, model=model)
-    results = output.results[0].model_dump()
+    results = _moderation_to_dict(output.results[0])
 
     return results
 
 
-# TODO: NOT TESTED
-class JsonBooleanChecker(BaseCumulativeTransformOutputParser[Any]):
-    """Check the output of a JSON to check if boolean are parsed correctly"""
+async def aget_openai_moderator_results(
+    input_message: str, model: str = "text-moderation-latest"
+) -> Dict:
+    """Async version of get_openai_moderator_results
+
+    Args:
+        input_message (str):
+            Message you want to check with openai's moderation model
+        model (str, optional):
+            moderation model -> look at openai's documentation.
+            Defaults to "text-moderation-latest".
+
+    Returns:
+        Dict: Results of the moderation model
+    """
+    client = _get_async_client()
+    output = await client.moderations.create(input=input_message, model=model)
+    results = _moderation_to_dict(output.results[0])
+
+    return results
+
 
-    true_vals = ["true", "right", "yes"]
-    false_vals = ["false", "wrong", "no"]
+_TRUE_VALS = frozenset(("true", "right", "yes"))
+_FALSE_VALS = frozenset(("false", "wrong", "no"))
 
-    def parse_result(self, result: List[dict]) -> Any:
-        for key, val in result.items():
-            if not isinstance(val, bool) and val.lower() in self.true_vals:
-                result[key] = True
-            elif not isinstance(val, bool) and val.lower() in self.false_vals:
-                result[key] = False
-            else:
-                continue
 
-        return result
+class JsonBooleanChecker(JsonOutputParser):
+    """Parse the output of a JSON and check if booleans are parsed correctly.
+    Strings like "yes" or "False" are converted to booleans, all other
+    values stay unchanged."""
 
-    def parse(self, result: dict) -> Any:
-        return self.parse_result(result)
+    def _convert_booleans(self, parsed: dict) -> dict:
+        for key, val in parsed.items():
+            if not isinstance(val, str):
+                continue
+            val = val.lower()
+            if val in _TRUE_VALS:
+                parsed[key] = True
+            elif val in _FALSE_VALS:
+                parsed[key] = False
+
+        return parsed
+
+    def parse_result(self, result: List[Generation], *, partial: bool = False) -> Any:
+        parsed = super().parse_result(result, partial=partial)
+        # Values of partial results could still be streamed ("No" -> "No hate
+        # speech"), so only the final result is converted
+        if partial or not isinstance(parsed, dict):
+            return parsed
+
+        return self._convert_booleans(parsed)
+
+    def _final_chunks(self, prev_parsed: Any) -> Iterator[Any]:
+        """The streamed results are parsed as partial results, the booleans
+        are converted after the last chunk arrived"""
+        if not isinstance(prev_parsed, dict):
+            return
+        converted = self._convert_booleans(dict(prev_parsed))
+        if converted != prev_parsed:
+            yield self._diff(prev_parsed, converted) if self.diff else converted
+
+    def _transform(self, input: Iterator[Union[str, BaseMessage]]) -> Iterator[Any]:
+        prev_parsed = None
+        for chunk in super()._transform(input):
+            prev_parsed = (
+                jsonpatch.apply_patch(prev_parsed, chunk) if self.diff else chunk
+            )
+            yield chunk
+        yield from self._final_chunks(prev_parsed)
+
+    async def _atransform(
+        self, input: AsyncIterator[Union[str, BaseMessage]]
+    ) -> AsyncIterator[Any]:
+        prev_parsed = None
+        async for chunk in super()._atransform(input):
+            prev_parsed = (
+                jsonpatch.apply_patch(prev_parsed, chunk) if self.diff else chunk
+            )
+            yield chunk
+        for chunk in self._final_chunks(prev_parsed):
+            yield chunk
 
     @property
     def _type(self) -> str:
@@ -1,9 +1,36 @@
-from typing import List
+from functools import lru_cache
+from typing import List, Type
 
-from langchain.prompts import PromptTemplate
+from langchain.prompts import (
+    ChatPromptTemplate,
+    HumanMessagePromptTemplate,
+    SystemMessagePromptTemplate,
+)
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.pydantic_v1 import BaseModel, Field
 
+
+@lru_cache(maxsize=None)
+def get_json_parser(pydantic_object: Type[BaseModel]) -> JsonOutputParser:
+    """Returns one shared JsonOutputParser per output format"""
+    return JsonOutputParser(pydantic_object=pydantic_object)
+
+
+@lru_cache(maxsize=None)
+def _format_instructions(pydantic_object: Type[BaseModel]) -> str:
+    return get_json_parser(pydantic_object).get_format_instructions()
+
+
+# The static instructions are passed as system message and only the message
+# as human message. The system message is the same for every request, so
+# the provider can cache the processed prefix (prompt caching).
+_MESSAGE = """<message>
+{message}
+</message>
+
+Answer:
+"""
+
 ### Hatespeech Detector - Prompt written by myself, refined with gpt4
 _HATESPEECH_DETECTOR = """You are a hate speech expert. Your role is to categorize each message by analyzing its content for the presence and type of hate speech.
 Utilize the following definitions which are delimited with XML tags to ensure accurate and nuanced classifications:
@@ -36,12 +63,6 @@ Carefully read each message, paying close attention to the context and the langu
 Your detailed assessment is vital for ensuring a respectful and safe communication environment.
 First explain your conclusion in 80 words and categorize it. Always answer in the following format:
 {format_instructions}
-
-<message>
-{message}
-</message>
-
-Answer:
 """
 
 
@@ -55,14 +76,15 @@ class HatespeechDetectionFormat(BaseModel):
 
 
 
-HATESPEECH_DETECTOR_PROMPT = PromptTemplate(
+HATESPEECH_DETECTOR_PROMPT = ChatPromptTemplate(
     name="detector",
-    template=_HATESPEECH_DETECTOR,
+    messages=[
+        SystemMessagePromptTemplate.from_template(_HATESPEECH_DETECTOR),
+        HumanMessagePromptTemplate.from_template(_MESSAGE),
+    ],
     input_variables=["message"],
     partial_variables={
-        "format_instructions": JsonOutputParser(
-            pydantic_object=HatespeechDetectionFormat
-        ).get_format_instructions()
+        "format_instructions": _format_instructions(HatespeechDetectionFormat)
     },
 )
 
@@ -81,19 +103,20 @@ Instructions: Carefully read the message, paying close attention to the context
 the provided definitions, focusing on how hate speech is presented and the author's intent. Your detailed assessment is vital for ensuring a respectful
 and safe communication environment. Always think step by step and decide based on your conclusion. Provide your perspective to the message and explain your conclusion.
 
-Here is the classification provided by the previous expert below:
-<opinion>    
+Always answer in the following format:
+{format_instructions}
+"""
+
+_HATESPEECH_VALIDATOR_MESSAGE = """Here is the classification provided by the previous expert below:
+<opinion>
 Classification: {classification}
-</opinion>    
+</opinion>
 
 Review the content of the message:
 <message>
 {message}
 </message>
 
-Always answer in the following format:
-{format_instructions}
-
 Answer:
 """
 
@@ -107,14 +130,74 @@ class HatespeechValidatorFormat(BaseModel):
     )
 
 
-HATESPEECH_VALIDATOR_PROMPT = PromptTemplate(
+HATESPEECH_VALIDATOR_PROMPT = ChatPromptTemplate(
     name="validator",
-    template=_HATESPEECH_VALIDATOR,
-    input_variables=["classification", "explanation", "message"],
+    messages=[
+        SystemMessagePromptTemplate.from_template(_HATESPEECH_VALIDATOR),
+        HumanMessagePromptTemplate.from_template(_HATESPEECH_VALIDATOR_MESSAGE),
+    ],
+    input_variables=["classification", "message"],
     partial_variables={
-        "format_instructions": JsonOutputParser(
-            pydantic_object=HatespeechValidatorFormat
-        ).get_format_instructions()
+        "format_instructions": _format_instructions(HatespeechValidatorFormat)
+    },
+)
+
+### Hatespeech Detector + Validator in one request - combination of both prompts above
+_HATESPEECH_DETECT_AND_VALIDATE = """You are a hate speech expert. Your role is to categorize each message by analyzing its content for the presence and type of hate speech.
+Utilize the following definitions which are delimited with XML tags to ensure accurate and nuanced classifications:
+
+<category>Direct hate speech</category>
+<definition>This category is for messages where the author explicitly expresses hate speech. The content directly reflects the author's own views,
+showing an intention to disparage, demean, or express hostility towards individuals or groups based on race, ethnicity, religion, gender, sexual orientation,
+or other identity markers. Direct hate speech is characterized by the author's use of derogatory language, slurs, or any explicit statements that promote
+hatred or discrimination. This does not include any personal experience where the author was the victim of hate speech.</definition>
+
+<category>Indirect hate speech</category>
+<definition>Assign a message to this category if it contains hate speech articulated through the lens of personal experiences
+or observations, yet does not directly express the author's personal hateful beliefs. This includes scenarios where the author discusses hate speech encountered
+in personal experiences, shares narratives that include hate speech to highlight societal issues, or articulates scenarios involving hate speech without endorsing it.
+This category also could include quoting someone else's hate speech</definition>
+
+<category>No hate speech</category>
+<definition>Messages without any form of hate speech, derogatory, discriminatory, or hostile language towards any group or individual,
+belong here. This includes content that is neutral, positive, or unrelated to hate speech.</definition>
+
+<category>Review needed</category>
+<definition>The message exhibits some characteristics of hate speech but is not definitive, and therefore, further review is necessary.</definition>
+
+<category>Unknown</category>
+<definition>If the classification is unclear due to lack of context, ambiguous language, or other factors preventing a definitive categorization,
+label the message as "Unknown." This category is for messages that need additional information or context for accurate classification.</definition>
+
+Work in two steps:
+    1. Detector: Carefully read the message, paying close attention to the context and the language used. Explain your conclusion in 80 words and categorize it.
+    2. Validator: Re-evaluate the classification of the first step as if you were a second, independent expert. Accurately apply the categories based on
+    the provided definitions, focusing on how hate speech is presented and the author's intent. Explain if you agree or disagree with the first classification.
+
+Always think step by step and decide based on your conclusion. Your detailed assessment is vital for ensuring a respectful and safe communication environment.
+Always answer in the following format:
+{format_instructions}
+"""
+
+
+class DetectValidateFormat(BaseModel):
+    detector: HatespeechDetectionFormat = Field(
+        description="The classification and explanation of the first step (detector)"
+    )
+    validator: HatespeechValidatorFormat = Field(
+        description="The classification and explanation of the second step (validator)"
+    )
+
+
+HATESPEECH_DETECT_AND_VALIDATE_PROMPT = ChatPromptTemplate(
+    name="detection",
+    messages=[
+        SystemMessagePromptTemplate.from_template(_HATESPEECH_DETECT_AND_VALIDATE),
+        HumanMessagePromptTemplate.from_template(_MESSAGE),
+    ],
+    input_variables=["message"],
+    partial_variables={
+        "format_instructions": _format_instructions(DetectValidateFormat)
     },
 )
 
@@ -150,12 +233,6 @@ General instructions:
 
 Always answer in the following format:
 {format_instructions}
-
-<message>
-{message}
-</message>
-
-Answer:
 """
 
 
@@ -189,14 +266,15 @@ class HatespeechClassifierFormat(BaseModel):
     )
 
 
-HATESPEECH_CLASSIFICATION_PROMPT = PromptTemplate(
+HATESPEECH_CLASSIFICATION_PROMPT = ChatPromptTemplate(
     name="classifier",
-    template=_HATESPEECH_CLASSIFIER,
+    messages=[
+        SystemMessagePromptTemplate.from_template(_HATESPEECH_CLASSIFIER),
+        HumanMessagePromptTemplate.from_template(_MESSAGE),
+    ],
     input_variables=["message"],
     partial_variables={
-        "format_instructions": JsonOutputParser(
-            pydantic_object=HatespeechClassifierFormat
-        ).get_format_instructions()
+        "format_instructions": _format_instructions(HatespeechClassifierFormat)
     },
 )
 
@@ -222,12 +300,6 @@ Always think step by step and decide based on your conclusion. Also explain why
 
 Always answer in the following format:
 {format_instructions}
-
-<message>
-{message}
-</message>
-
-Answer:
 """
 
 
@@ -237,14 +309,15 @@ class RightWingRatingFormat(BaseModel):
     explanation: str = Field(description="A comprehensive explanation of your rating.")
 
 
-RIGHT_WING_RATING_PROMPT = PromptTemplate(
+RIGHT_WING_RATING_PROMPT = ChatPromptTemplate(
     name="right-wing-rater",
-    template=_RIGHT_WING_RATER,
+    messages=[
+        SystemMessagePromptTemplate.from_template(_RIGHT_WING_RATER),
+        HumanMessagePromptTemplate.from_template(_MESSAGE),
+    ],
     input_variables=["message"],
     partial_variables={
-        "format_instructions": JsonOutputParser(
-            pydantic_object=RightWingRatingFormat
-        ).get_format_instructions()
+        "format_instructions": _format_instructions(RightWingRatingFormat)
     },
 )
 
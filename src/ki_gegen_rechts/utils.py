@@ -1,3 +1,6 @@
+from collections import defaultdict
+from itertools import chain
+
 import pandas as pd
 from IPython.core.display import display, HTML
 
@@ -21,26 +24,39 @@ RESULTS_STYLE = [
     ),
 ]
 
-
-def _find_dict_values_with_parent(d, parent_key=None, target_keys=["classification"]):
-    """Recursively finds values of specified keys in a nested dictionary and
-    returns them with their parent key."""
-    if isinstance(d, dict):
-        for k, v in d.items():
-            if (
-                k in target_keys
-            ):  # Check if the current key is in the list of target keys
+_TARGET_KEYS = frozenset(("classification",))
+_EXCLUDE_KEYS = frozenset(("explanation", "classification"))
+_EXPLANATION_KEYS = frozenset(("classification", "explanation", "rating"))
+_RIGHT_WING_EXCLUDE_KEYS = frozenset(("explanation", "rating"))
+
+
+def _find_dict_values_with_parent(d, parent_key=None, target_keys=_TARGET_KEYS):
+    """Finds values of specified keys in a nested dictionary and returns them
+    with their parent key. Walks the dictionary with a stack of iterators
+    instead of recursion, the order of the results stays the same."""
+    if not isinstance(d, dict):
+        return
+    target_keys = frozenset(target_keys)
+    stack = [(parent_key, iter(d.items()))]
+    while stack:
+        parent_key, items = stack[-1]
+        for k, v in items:
+            if k in target_keys:
                 yield (parent_key, v)
             elif isinstance(v, dict):
-                yield from _find_dict_values_with_parent(v, k, target_keys)
+                stack.append((k, iter(v.items())))
+                break
             elif isinstance(v, list):
-                for item in v:
-                    yield from _find_dict_values_with_parent(item, k, target_keys)
+                dicts = (item for item in v if isinstance(item, dict))
+                stack.append((k, chain.from_iterable(i.items() for i in dicts)))
+                break
+        else:
+            stack.pop()
 
 
-def _drop_dict_values(result: dict, exclude_keys=["explanation", "classification"]):
+def _drop_dict_values(result: dict, exclude_keys=_EXCLUDE_KEYS):
     """Helper function to drop/exclude specific keys from a dictionary"""
-    return {k: result[k] for k in set(list(result.keys())) - set(exclude_keys)}
+    return {k: v for k, v in result.items() if k not in exclude_keys}
 
 
 def _bool_to_dot(value):
@@ -53,47 +69,28 @@ def _bool_to_dot(value):
 
 def _tuple_to_dict(tuple_pairs):
     # Create a structured dictionary to accommodate values for each index
-    structured_data = {}
+    structured_data = defaultdict(list)
     for key, value in tuple_pairs:
-        if key not in structured_data:
-            structured_data[key] = [value]
-        else:
-            structured_data[key].append(value)
+        structured_data[key].append(value)
 
-    return structured_data
+    return dict(structured_data)
 
 
 def create_tables_single_result(result):
-    tuple_pairs = list(
-        _find_dict_values_with_parent(
-            result, target_keys=["classification", "explanation", "rating"]
-        )
-    )
-    explanations = _tuple_to_dict(list(tuple_pairs))
+    tuple_pairs = _find_dict_values_with_parent(result, target_keys=_EXPLANATION_KEYS)
+    explanations = _tuple_to_dict(tuple_pairs)
     mod_tags = result["moderator"]["mod_results"]["categories"]
     classifier_tags = _drop_dict_values(result["classifier"])
-    rw_indicator = _drop_dict_values(result["right_wing_rater"],
-                                     exclude_keys=["explanation", "rating"])
-
-    df_mod = pd.DataFrame(
-        [list(mod_tags.values())],
-        columns=pd.MultiIndex.from_product(
-            [["Moderator Results"], list(mod_tags.keys())]
-        ),
-    )
-    df_classifier = pd.DataFrame(
-        [list(classifier_tags.values())],
-        columns=pd.MultiIndex.from_product(
-            [["Hate Speech Classifier"], list(classifier_tags.keys())]
-        ),
+    rw_indicator = _drop_dict_values(
+        result["right_wing_rater"], exclude_keys=_RIGHT_WING_EXCLUDE_KEYS
     )
-    df_rw = pd.DataFrame(
-        [list(rw_indicator.values())],
-        columns=pd.MultiIndex.from_product(
-            [["Right Wing Rater"], list(rw_indicator.keys())]))
+
+    row = {("Hate Speech Classifier", k): v for k, v in classifier_tags.items()}
+    row.update({("Right Wing Rater", k): v for k, v in rw_indicator.items()})
+    row.update({("Moderator Results", k): v for k, v in mod_tags.items()})
 
     df_results = (
-        pd.concat([df_classifier, df_rw, df_mod], axis=1)
+        pd.DataFrame([list(row.values())], columns=pd.MultiIndex.from_tuples(list(row)))
         .rename(columns={0: "Evaluation"})
         .sort_index()
     )
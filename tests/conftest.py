@@ -0,0 +1,5 @@
+import os
+
+# The analyser builds its default OpenAI clients at import, they need a key
+# but no network
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
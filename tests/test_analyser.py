@@ -0,0 +1,120 @@
+import asyncio
+import json
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+from ki_gegen_rechts import analyser
+from ki_gegen_rechts.analyser import analyse_many_dedup, routed_text_analyser_chains
+
+
+_CLASSIFIER = {
+    "classification": "Offensive insult",
+    "racism": True,
+    "antisemitism": False,
+    "homophobia": False,
+    "ableism": False,
+    "violence": False,
+    "sexism": False,
+    "other_hate_speech": False,
+    "explanation": "classifier",
+}
+_RIGHT_WING_RATER = {
+    "right_wing_indicator": True,
+    "rating": "Category 2",
+    "explanation": "rater",
+}
+
+
+def _fake_llm(detector: str, validator: str, calls: list):
+    """Answers every prompt with a fixed JSON and records which prompt ran"""
+    answers = {
+        "detection": {
+            "detector": {"explanation": "detector", "classification": detector},
+            "validator": {"classification": validator, "explanation": "validator"},
+        },
+        "classifier": _CLASSIFIER,
+        "right-wing-rater": _RIGHT_WING_RATER,
+    }
+
+    def answer(prompt_value):
+        system = prompt_value.to_messages()[0].content
+        if "Validator:" in system:
+            name = "detection"
+        elif "right-wing" in system:
+            name = "right-wing-rater"
+        else:
+            name = "classifier"
+        calls.append(name)
+        return AIMessage(content=json.dumps(answers[name]))
+
+    return RunnableLambda(answer)
+
+
+def _fake_moderator(flagged: bool):
+    return RunnableLambda(
+        lambda inputs: {
+            "message": inputs["message"],
+            "mod_results": {"flagged": flagged},
+        }
+    )
+
+
+def _run_routed(detector: str, validator: str, flagged: bool = False):
+    calls = []
+    chain = routed_text_analyser_chains(
+        _fake_llm(detector, validator, calls), _fake_moderator(flagged)
+    )
+    return chain.invoke({"message": "Nice day!"}), calls
+
+
+def test_routed_chain_skips_benign_messages():
+    result, calls = _run_routed("No hate speech", "No hate speech")
+    assert calls == ["detection"]
+    assert "message" not in result
+    assert result["classifier"]["classification"] == "Skipped"
+    assert not any(v for v in result["classifier"].values() if isinstance(v, bool))
+    assert result["right_wing_rater"]["rating"] == "Skipped"
+    assert result["right_wing_rater"]["right_wing_indicator"] is False
+
+
+def test_routed_chain_runs_all_chains_if_flagged():
+    result, calls = _run_routed("No hate speech", "No hate speech", flagged=True)
+    assert sorted(calls) == ["classifier", "detection", "right-wing-rater"]
+    assert "message" not in result
+    assert result["classifier"] == _CLASSIFIER
+    assert result["right_wing_rater"] == _RIGHT_WING_RATER
+
+
+def test_routed_chain_runs_all_chains_if_classifications_differ():
+    result, calls = _run_routed("No hate speech", "Indirect hate speech")
+    assert sorted(calls) == ["classifier", "detection", "right-wing-rater"]
+    assert "message" not in result
+    assert result["classifier"] == _CLASSIFIER
+
+
+def test_routed_chain_compares_classifications_loosely():
+    result, calls = _run_routed(" no hate speech.", "No Hate Speech")
+    assert calls == ["detection"]
+    assert "message" not in result
+    assert result["classifier"]["classification"] == "Skipped"
+
+
+def test_analyse_many_dedup(monkeypatch):
+    sent = []
+
+    def fake_chain(inputs):
+        sent.append(inputs["message"])
+        return {"message": inputs["message"].strip().lower()}
+
+    monkeypatch.setattr(
+        analyser,
+        "parallel_text_analyser_chains",
+        lambda *args, **kwargs: RunnableLambda(fake_chain),
+    )
+    res = asyncio.run(analyse_many_dedup(["a", " A ", "b"]))
+
+    assert len(sent) == 2
+    assert res == [{"message": "a"}, {"message": "a"}, {"message": "b"}]
+    assert res[0] == res[1]
+    assert res[0] is not res[1]
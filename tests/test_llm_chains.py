@@ -0,0 +1,90 @@
+import asyncio
+
+import jsonpatch
+from langchain_core.outputs import Generation
+
+from ki_gegen_rechts.llm_chains import JsonBooleanChecker, OpenAIModerationChain
+
+
+_OUTPUT = (
+    '{"racism": "Yes", "sexism": true, "rating": 3, "other": null, "text": "maybe"}'
+)
+_EXPECTED = {
+    "racism": True,
+    "sexism": True,
+    "rating": 3,
+    "other": None,
+    "text": "maybe",
+}
+
+
+def test_json_boolean_checker_parse():
+    assert JsonBooleanChecker().parse(_OUTPUT) == _EXPECTED
+
+
+def test_json_boolean_checker_parse_result():
+    result = JsonBooleanChecker().parse_result([Generation(text=_OUTPUT)])
+    assert result == _EXPECTED
+
+
+def test_json_boolean_checker_false_values():
+    output = '{"a": "no", "b": "False", "c": "WRONG", "d": false}'
+    expected = {"a": False, "b": False, "c": False, "d": False}
+    assert JsonBooleanChecker().parse(output) == expected
+
+
+def test_json_boolean_checker_in_chain():
+    assert JsonBooleanChecker().invoke(_OUTPUT) == _EXPECTED
+
+
+def test_json_boolean_checker_stream():
+    chunks = list(JsonBooleanChecker().transform(iter(['{"racism": "Y', 'es"}'])))
+    assert chunks[-1] == {"racism": True}
+
+
+def test_json_boolean_checker_stream_keeps_partial_values():
+    chunks = list(
+        JsonBooleanChecker().transform(
+            iter(['{"classification": "No', ' hate speech", "racism": "no"}'])
+        )
+    )
+    assert {"classification": False} not in chunks
+    assert chunks[-1] == {"classification": "No hate speech", "racism": False}
+
+
+def test_json_boolean_checker_stream_diff():
+    chunks = JsonBooleanChecker(diff=True).transform(
+        iter(['{"classification": "No', ' hate speech", "racism": "no"}'])
+    )
+    result = None
+    for patch in chunks:
+        result = jsonpatch.apply_patch(result, patch)
+    assert result == {"classification": "No hate speech", "racism": False}
+
+
+async def _astream(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def test_json_boolean_checker_astream():
+    async def collect():
+        stream = JsonBooleanChecker().atransform(_astream(['{"racism": "n', 'o"}']))
+        return [chunk async for chunk in stream]
+
+    chunks = asyncio.run(collect())
+    assert chunks[-1] == {"racism": False}
+    assert {"racism": False} not in chunks[:-1]
+
+
+def test_moderation_chain_reuses_async_client_per_loop():
+    moderation = OpenAIModerationChain()
+
+    async def clients():
+        return moderation._get_loop_async_client(), moderation._get_loop_async_client()
+
+    first, second = asyncio.run(clients())
+    assert first is second
+    third, _ = asyncio.run(clients())
+    assert third is not first
+    assert len(moderation.async_clients) == 1
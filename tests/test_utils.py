@@ -0,0 +1,54 @@
+from ki_gegen_rechts.utils import (
+    _drop_dict_values,
+    _find_dict_values_with_parent,
+    _tuple_to_dict,
+)
+
+
+_RESULT = {
+    "detection": {
+        "detector": {"explanation": "a", "classification": "No hate speech"},
+        "validator": {"classification": "No hate speech", "explanation": "b"},
+    },
+    "classifier": {"classification": "Offensive insult", "racism": True},
+    "right_wing_rater": {"right_wing_indicator": False, "rating": "Category 0"},
+}
+
+
+def test_find_dict_values_with_parent_nested():
+    target_keys = ["classification", "explanation", "rating"]
+    assert list(_find_dict_values_with_parent(_RESULT, target_keys=target_keys)) == [
+        ("detector", "a"),
+        ("detector", "No hate speech"),
+        ("validator", "No hate speech"),
+        ("validator", "b"),
+        ("classifier", "Offensive insult"),
+        ("right_wing_rater", "Category 0"),
+    ]
+
+
+def test_find_dict_values_with_parent_list_of_dicts():
+    result = {
+        "results": [
+            {"classification": 1, "nested": {"classification": 2}},
+            "ignored",
+            {"classification": 3},
+        ],
+        "classification": 4,
+    }
+    assert list(_find_dict_values_with_parent(result)) == [
+        ("results", 1),
+        ("nested", 2),
+        ("results", 3),
+        (None, 4),
+    ]
+
+
+def test_drop_dict_values():
+    result = {"classification": "x", "racism": True, "explanation": "y"}
+    assert _drop_dict_values(result) == {"racism": True}
+
+
+def test_tuple_to_dict():
+    pairs = [("detector", "a"), ("validator", "b"), ("detector", "c")]
+    assert _tuple_to_dict(pairs) == {"detector": ["a", "c"], "validator": ["b"]}